@@ -1,11 +1,18 @@
 import os
 import base64
 import json
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime, timedelta, timezone
 from apscheduler.schedulers.blocking import BlockingScheduler
 import firebase_admin
 from firebase_admin import credentials, firestore
-from shapely.geometry import Point, Polygon
+from google.api_core.exceptions import Aborted, DeadlineExceeded, RetryError, ServiceUnavailable
+from google.api_core.retry import Retry, if_exception_type
+import numpy as np
 
 # -------------------------------
 # 🔐 Initialize Firebase
@@ -18,10 +25,184 @@ def init_firebase():
 init_firebase()
 db = firestore.client()
 
+# -------------------------------
+# ⚙️ Agency Setting Values
+# -------------------------------
+# activityReportFrequency -> minutes between inactivity checks
+FREQ_MINUTES = {"30min": 30, "1hr": 60, "2hr": 120}
+# licenseExpiryReminder -> days before expiry to remind
+LICENSE_DAYS = {"1week": 7, "2weeks": 14, "1month": 30}
+
+# -------------------------------
+# 🕰 Timestamp Parsing
+# -------------------------------
+# Stored timestamps are ISO strings ("...Z"). They are parsed once into naive
+# UTC datetimes so they compare directly against datetime.utcnow().
+@lru_cache(maxsize=100_000)
+def iso_to_dt(value):
+    dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+# Seconds since the epoch, for elapsed-time checks that need no timedelta
+@lru_cache(maxsize=100_000)
+def iso_to_ts(value):
+    return iso_to_dt(value).replace(tzinfo=timezone.utc).timestamp()
+
+# -------------------------------
+# 🗂 Cached Reference Data
+# -------------------------------
+# Settings and sites change rarely, so they are re-read at most once per TTL
+# window and shared by every job that runs inside it.
+SETTINGS_TTL_SECONDS = 60
+SITES_TTL_SECONDS = 300
+
+@lru_cache(maxsize=1)
+def _load_agency_settings(ttl_bucket):
+    return {s.id: s.to_dict() for s in db.collection("agencySettings").stream()}
+
+def get_agency_settings():
+    return _load_agency_settings(int(time.time() // SETTINGS_TTL_SECONDS))
+
+@lru_cache(maxsize=1)
+def _load_sites(ttl_bucket):
+    return {s.id: s.to_dict() for s in db.collection("sites").stream()}
+
+@lru_cache(maxsize=1)
+def _load_site_polygons(ttl_bucket):
+    # Vertex arrays per site (lngs, lats), built once per sites TTL window
+    polygons = {}
+    for site_id, site in _load_sites(ttl_bucket).items():
+        coords = site.get("coordinates", [])
+        if len(coords) < 3:
+            continue
+        lngs = np.array([c["lng"] for c in coords], dtype=float)
+        lats = np.array([c["lat"] for c in coords], dtype=float)
+        polygons[site_id] = (lngs, lats)
+    return polygons
+
+def get_site_polygons():
+    return _load_site_polygons(int(time.time() // SITES_TTL_SECONDS))
+
+# -------------------------------
+# 🧵 Parallel Fan-Out
+# -------------------------------
+# Per-agency work is dominated by Firestore round-trips, so it is spread over
+# a thread pool rather than run one agency at a time.
+MAX_WORKERS = 40
+
+def run_parallel(fn, items):
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        # list() drains the results so a failure in any worker is re-raised here
+        return list(ex.map(lambda args: fn(*args), items))
+
+# Bulk document reads are split into chunks that are fetched concurrently,
+# so at most MAX_WORKERS get_all() calls are in flight at once.
+GET_ALL_CHUNK = 100
+
+def get_all_chunked(refs, field_paths=None):
+    chunks = [(refs[i:i + GET_ALL_CHUNK],) for i in range(0, len(refs), GET_ALL_CHUNK)]
+    pages = run_parallel(lambda chunk: list(db.get_all(chunk, field_paths=field_paths)), chunks)
+    return [snap for page in pages for snap in page]
+
+# -------------------------------
+# 📄 Paged Queries
+# -------------------------------
+# Large collections are read a page at a time with a cursor, which keeps the
+# client's buffered results bounded instead of holding a whole stream.
+PAGE_SIZE = 500
+
+def paged(query, size=PAGE_SIZE):
+    query = query.order_by("__name__").limit(size)
+    last = None
+    while True:
+        page = query.start_after(last) if last is not None else query
+        docs = list(page.stream())
+        if not docs:
+            break
+        yield from docs
+        if len(docs) < size:
+            break
+        last = docs[-1]
+
+# -------------------------------
+# ✍️ Batched Writes
+# -------------------------------
+# Firestore caps a WriteBatch at 500 operations.
+BATCH_LIMIT = 500
+# A batch that still fails after retrying is re-sent in smaller pieces; a
+# multiple of 3 keeps each auto clock-out's writes in the same piece.
+RETRY_BATCH_LIMIT = 99
+
+# Transient commit failures are retried with exponential backoff.
+COMMIT_RETRY = Retry(
+    predicate=if_exception_type(Aborted, ServiceUnavailable, DeadlineExceeded),
+    initial=0.5,
+    maximum=10.0,
+    multiplier=2.0,
+    timeout=60.0,
+)
+
+def _commit_chunk(chunk):
+    batch = db.batch()
+    for method, ref, data, *options in chunk:
+        getattr(batch, method)(ref, data, **(options[0] if options else {}))
+    batch.commit(retry=COMMIT_RETRY)
+
+def commit_writes(writes):
+    # writes are (method, ref, data) tuples, e.g. ("update", ref, {...}), with
+    # an optional fourth element of keyword options, e.g. {"merge": True}
+    for i in range(0, len(writes), BATCH_LIMIT):
+        chunk = writes[i:i + BATCH_LIMIT]
+        try:
+            _commit_chunk(chunk)
+        except (RetryError, Aborted, ServiceUnavailable, DeadlineExceeded):
+            if len(chunk) <= RETRY_BATCH_LIMIT:
+                raise
+            # Smaller batches touch fewer documents and are less likely to conflict
+            for j in range(0, len(chunk), RETRY_BATCH_LIMIT):
+                _commit_chunk(chunk[j:j + RETRY_BATCH_LIMIT])
+
+# -------------------------------
+# 📌 Job Completion Markers
+# -------------------------------
+# agencyJobsState/{agencyId} holds one field per job with the last day (UTC,
+# YYYY-MM-DD) that job completed for the agency, so a re-run is a no-op.
+def get_job_markers(job, agency_ids):
+    state_col = db.collection("agencyJobsState")
+    refs = [state_col.document(aid) for aid in agency_ids]
+    if not refs:
+        return {}
+    return {
+        snap.id: (snap.to_dict() or {}).get(job)
+        for snap in db.get_all(refs, field_paths=[job]) if snap.exists
+    }
+
+def set_job_markers(job, agency_ids, value):
+    state_col = db.collection("agencyJobsState")
+    commit_writes([("set", state_col.document(aid), {job: value}, {"merge": True}) for aid in agency_ids])
+
 # -------------------------------
 # 🔔 System Alert Creator
 # -------------------------------
-def create_system_alert(agency_id, title, message, severity="medium", category="generic", site_id=None):
+# Alerts are queued on the calling job's thread and written in batches by
+# flush_alerts() instead of one add() round-trip each. The queue is
+# thread-local so a job only ever flushes (and is answerable for) its own
+# alerts; create_system_alert must not be called from run_parallel workers.
+#
+# systemAlerts is append-only: each alert is written once to a fresh document
+# and never read back and modified. Keep these writes in plain WriteBatches,
+# not db.transaction(); a transaction would add read locks and contention
+# retries for no benefit.
+_pending = threading.local()
+
+def _pending_alerts():
+    if not hasattr(_pending, "alerts"):
+        _pending.alerts = []
+    return _pending.alerts
+
+def build_system_alert(agency_id, title, message, severity="medium", category="generic", site_id=None, shift_id=None, ts=None):
     alert = {
         "agencyId": agency_id,
         "title": title,
@@ -29,232 +210,458 @@ def create_system_alert(agency_id, title, message, severity="medium", category="
         "severity": severity,
         "category": category,
         "siteId": site_id,
-        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "timestamp": ts or datetime.utcnow().isoformat() + "Z",
         "read": False
     }
-    db.collection("systemAlerts").add(alert)
+    if shift_id:
+        alert["shiftId"] = shift_id
+    return db.collection("systemAlerts").document(), alert
+
+def create_system_alert(*args, **kwargs):
+    pending = _pending_alerts()
+    pending.append(build_system_alert(*args, **kwargs))
+    # Write out a full batch as soon as one is ready so long scans stay bounded
+    if len(pending) >= BATCH_LIMIT:
+        flush_alerts()
+
+def flush_alerts():
+    pending = _pending_alerts()
+    writes = pending[:]
+    pending.clear()
+    commit_writes([("set", ref, data) for ref, data in writes])
+
+# -------------------------------
+# 👥 Shared Employee Snapshot
+# -------------------------------
+def load_employees():
+    # One read of the fields the inactivity and geofence checks both need
+    return [emp.to_dict() for emp in paged(db.collection("employees")
+        .select(["agencyId", "assignedsiteID", "lastKnownLocation", "name"]))]
 
 # -------------------------------
 # 🕒 Clock-In Grace Period Violation (NEW)
 # -------------------------------
-def check_grace_violations():
+def _run_grace(now, settings):
     print("[⏱] Running check_grace_violations...")
-    now = datetime.utcnow()
-    settings = db.collection("agencySettings").stream()
+    now_iso = now.isoformat() + "Z"
 
-    for s in settings:
-        agency_id = s.id
-        grace_minutes = s.to_dict().get("clockInGracePeriod", 5)
+    # Per-agency cut-off for shiftStart; agencies with the grace check off are left out
+    thresholds = {}
+    for agency_id, config in settings.items():
+        grace_minutes = config.get("clockInGracePeriod", 5)
         if grace_minutes == 0:
             continue
+        thresholds[agency_id] = (now - timedelta(minutes=grace_minutes)).isoformat() + "Z"
+    if not thresholds:
+        return
 
-        threshold_time = now - timedelta(minutes=grace_minutes)
+    shifts_col = db.collection("shifts")
 
-        shifts = db.collection("shifts") \
+    # Only agencies with the check on are queried, each with its own cut-off
+    def overdue_shifts(agency_id, threshold):
+        shifts = shifts_col \
             .where("agencyId", "==", agency_id) \
-            .where("shiftStart", "<=", threshold_time.isoformat() + "Z") \
+            .where("shiftStart", "<=", threshold) \
+            .select(["agencyId", "shiftStart", "employeeId", "siteId"]) \
             .stream()
+        return [(shift_doc.id, shift_doc.to_dict()) for shift_doc in shifts]
+
+    pages = run_parallel(overdue_shifts, thresholds.items())
+    candidates = [c for page in pages for c in page]
 
-        for shift_doc in shifts:
-            shift = shift_doc.to_dict()
-            shift_id = shift_doc.id
-
-            # Skip if already clocked in
-            attendance = db.collection("attendance") \
-                .where("shiftId", "==", shift_id) \
-                .where("agencyId", "==", agency_id) \
-                .limit(1).stream()
-
-            if any(True for _ in attendance):
-                continue
-
-            # Check if an alert for this shift already exists
-            existing_alerts = db.collection("systemAlerts") \
-                .where("agencyId", "==", agency_id) \
-                .where("category", "==", "late_clockin") \
-                .where("siteId", "==", shift.get("siteId")) \
-                .where("timestamp", ">=", (now - timedelta(hours=1)).isoformat() + "Z") \
-                .stream()
-
-            duplicate_found = False
-            for alert in existing_alerts:
-                data = alert.to_dict()
-                if data.get("metadata", {}).get("shiftId") == shift_id:
-                    duplicate_found = True
-                    break
-            if duplicate_found:
-                continue
-
-            # Get employee name
-            emp_id = shift.get("employeeId", "")
-            emp_name = emp_id
-            emp_doc = db.collection("employees").document(emp_id).get()
-            if emp_doc.exists:
-                emp_name = emp_doc.to_dict().get("name", emp_id)
-
-            # Create alert (store shiftId in metadata only)
-            alert_data = {
-                "agencyId": agency_id,
-                "title": "Clock-In Missed",
-                "message": f"Employee {emp_name} did not clock in for their shift starting at {shift['shiftStart'][11:16]}.",
-                "severity": "medium",
-                "category": "late_clockin",
-                "siteId": shift.get("siteId"),
-                "timestamp": now.isoformat() + "Z",
-                "read": False,
-                "metadata": { "shiftId": shift_id }  # invisible to UI but used for de-duping
-            }
-
-            db.collection("systemAlerts").add(alert_data)
-            print(f"🚨 Alert created: {emp_name} missed clock-in at {shift['shiftStart'][11:16]}")
+    attendance_col = db.collection("attendance")
+    alerts_col = db.collection("systemAlerts")
+    alert_window_start = (now - timedelta(hours=1)).isoformat() + "Z"
 
+    def is_missed(shift_id, shift):
+        agency_id = shift["agencyId"]
+
+        # Skip if already clocked in
+        attendance = attendance_col \
+            .where("shiftId", "==", shift_id) \
+            .where("agencyId", "==", agency_id) \
+            .select([]) \
+            .limit(1).stream()
+
+        if any(True for _ in attendance):
+            return False
+
+        # Check if an alert for this shift already exists (index on shiftId, category, timestamp)
+        existing_alert = alerts_col \
+            .where("shiftId", "==", shift_id) \
+            .where("category", "==", "late_clockin") \
+            .where("timestamp", ">=", alert_window_start) \
+            .limit(1).stream()
+
+        return not any(True for _ in existing_alert)
+
+    # Each check is a few independent lookups, so shifts are processed concurrently
+    missed = [c for c, flag in zip(candidates, run_parallel(is_missed, candidates)) if flag]
+    if not missed:
+        return
+
+    # Employee names for every missed shift in chunked bulk reads
+    emp_ids = {shift.get("employeeId", "") for _, shift in missed} - {""}
+    employees_col = db.collection("employees")
+    emp_refs = [employees_col.document(eid) for eid in emp_ids]
+    emp_names = {e.id: e.to_dict().get("name", e.id) for e in get_all_chunked(emp_refs, ["name"]) if e.exists}
+
+    for shift_id, shift in missed:
+        emp_id = shift.get("employeeId", "")
+        emp_name = emp_names.get(emp_id, emp_id)
+
+        # Create alert (shiftId is stored top-level for the de-dupe query above)
+        create_system_alert(
+            shift["agencyId"],
+            "Clock-In Missed",
+            f"Employee {emp_name} did not clock in for their shift starting at {shift['shiftStart'][11:16]}.",
+            category="late_clockin",
+            site_id=shift.get("siteId"),
+            shift_id=shift_id,
+            ts=now_iso
+        )
+        print(f"🚨 Alert created: {emp_name} missed clock-in at {shift['shiftStart'][11:16]}")
 
 # -------------------------------
 # 🔁 Auto Clock-Out
 # -------------------------------
-def auto_clockout_expired_shifts():
-    now = datetime.utcnow()
-    settings = db.collection("agencySettings").stream()
-    enabled_agencies = {s.id for s in settings if s.to_dict().get("autoClockOut", False)}
-
-    records = db.collection("attendance").where("clockOut", "==", None).stream()
+# Expired shifts are found through an autoClockOut flag on each shift, a copy
+# of agencySettings.autoClockOut, so the main query needs no settings read.
+# Shift writers outside this repo are expected to set it, but the scheduler
+# doesn't rely on that: _run_flag_sync copies the agency setting onto every
+# shift in the window below, and re-copies it after a setting change.
+#
+# Only shifts that ended within the lookback window are queried, so ended
+# shifts that never reach "completed" (e.g. no-shows) aren't re-read forever.
+# Attendance left open past the window (scheduler outage, late setting
+# change) is picked up separately by _run_stale_clockout.
+CLOCKOUT_LOOKBACK_HOURS = 24
+
+def _run_flag_sync(now, settings):
+    lookback_iso = (now - timedelta(hours=CLOCKOUT_LOOKBACK_HOURS)).isoformat() + "Z"
+    shifts_col = db.collection("shifts")
+
+    # Index on (agencyId, shiftEnd); covers recent and upcoming shifts
+    def stale_flags(agency_id, config):
+        enabled = bool(config.get("autoClockOut", False))
+        shifts = shifts_col \
+            .where("agencyId", "==", agency_id) \
+            .where("shiftEnd", ">=", lookback_iso) \
+            .select(["autoClockOut"]) \
+            .stream()
+        return [
+            ("update", doc.reference, {"autoClockOut": enabled})
+            for doc in shifts if doc.to_dict().get("autoClockOut") != enabled
+        ]
+
+    pages = run_parallel(stale_flags, settings.items())
+    commit_writes([w for page in pages for w in page])
+
+def _run_clockout(now):
+    now_iso = now.isoformat() + "Z"
+    lookback_iso = (now - timedelta(hours=CLOCKOUT_LOOKBACK_HOURS)).isoformat() + "Z"
+    attendance_col = db.collection("attendance")
+    shifts_col = db.collection("shifts")
+
+    # Index on (autoClockOut, shiftEnd). The lookback bound keeps the result
+    # small, so status is checked here rather than with a second inequality
+    # (which would also drop shifts that have no status field).
+    expired = shifts_col \
+        .where("autoClockOut", "==", True) \
+        .where("shiftEnd", ">=", lookback_iso) \
+        .where("shiftEnd", "<=", now_iso) \
+        .select(["shiftEnd", "status"]) \
+        .stream()
+    shift_ends = {}
+    for doc in expired:
+        shift = doc.to_dict()
+        if shift.get("status") != "completed":
+            shift_ends[doc.id] = shift["shiftEnd"]
+    if not shift_ends:
+        return
+
+    # Open attendance for those shifts; "in" takes at most 30 values per query
+    def open_attendance(shift_ids):
+        return list(attendance_col
+            .where("shiftId", "in", shift_ids)
+            .where("clockOut", "==", None)
+            .select(["agencyId", "shiftId", "clockIn", "userId"])
+            .stream())
+
+    shift_ids = list(shift_ends)
+    chunks = [(shift_ids[i:i + 30],) for i in range(0, len(shift_ids), 30)]
+    records = [doc for page in run_parallel(open_attendance, chunks) for doc in page]
+    _clock_out(now, records, shift_ends)
+
+def _run_stale_clockout(now, settings):
+    # Attendance still open from before the lookback window, decided by the
+    # agency setting directly since those shifts are outside the flag sync
+    lookback_iso = (now - timedelta(hours=CLOCKOUT_LOOKBACK_HOURS)).isoformat() + "Z"
+    shifts_col = db.collection("shifts")
+
+    # Index on (clockOut, clockIn)
+    records = [
+        doc for doc in db.collection("attendance")
+            .where("clockOut", "==", None)
+            .where("clockIn", "<=", lookback_iso)
+            .select(["agencyId", "shiftId", "clockIn", "userId"])
+            .stream()
+        if settings.get(doc.get("agencyId"), {}).get("autoClockOut", False) and doc.get("shiftId")
+    ]
+    if not records:
+        return
+
+    shift_refs = [shifts_col.document(sid) for sid in {doc.get("shiftId") for doc in records}]
+    shift_ends = {
+        snap.id: snap.to_dict()["shiftEnd"]
+        for snap in get_all_chunked(shift_refs, ["shiftEnd"]) if snap.exists
+    }
+    records = [doc for doc in records if doc.get("shiftId") in shift_ends]
+    print(f"[⏱] Closing {len(records)} attendance record(s) open past the auto clock-out window")
+    _clock_out(now, records, shift_ends)
+
+def _clock_out(now, records, shift_ends):
+    now_iso = now.isoformat() + "Z"
+    now_ts = now.replace(tzinfo=timezone.utc).timestamp()
+    shifts_col = db.collection("shifts")
+
+    # Clock-out, shift completion and the alert for one employee go in the
+    # same batch; a batch is committed before it would exceed BATCH_LIMIT.
+    writes = []
     for doc in records:
         att = doc.to_dict()
-        if att["agencyId"] not in enabled_agencies or not att.get("shiftId"):
+        if now_ts <= iso_to_ts(shift_ends[att["shiftId"]]):
             continue
-        shift_doc = db.collection("shifts").document(att["shiftId"]).get()
-        if not shift_doc.exists:
-            continue
-        shift = shift_doc.to_dict()
-        shift_end = datetime.fromisoformat(shift["shiftEnd"].replace("Z", "+00:00"))
-
-        if now > shift_end:
-            hours = round((now - datetime.fromisoformat(att["clockIn"].replace("Z", "+00:00"))).total_seconds() / 3600, 2)
-            db.collection("attendance").document(doc.id).update({
-                "clockOut": now.isoformat() + "Z",
-                "hoursWorked": hours,
-                "updatedAt": now.isoformat() + "Z"
-            })
-            db.collection("shifts").document(att["shiftId"]).update({
-                "status": "completed",
-                "updatedAt": now.isoformat() + "Z"
-            })
-            create_system_alert(
-                att["agencyId"],
-                "Auto Clock-Out Executed",
-                f"Employee {att['userId']} auto clocked out at shift end.",
-                category="auto_clockout"
-            )
+        hours = round((now_ts - iso_to_ts(att["clockIn"])) / 3600, 2)
+        if len(writes) + 3 > BATCH_LIMIT:
+            commit_writes(writes)
+            writes = []
+        writes.append(("update", doc.reference, {
+            "clockOut": now_iso,
+            "hoursWorked": hours,
+            "updatedAt": now_iso
+        }))
+        writes.append(("update", shifts_col.document(att["shiftId"]), {
+            "status": "completed",
+            "updatedAt": now_iso
+        }))
+        writes.append(("set", *build_system_alert(
+            att["agencyId"],
+            "Auto Clock-Out Executed",
+            f"Employee {att['userId']} auto clocked out at shift end.",
+            category="auto_clockout",
+            ts=now_iso
+        )))
+
+    commit_writes(writes)
 
 # -------------------------------
 # 🔕 Inactivity Reminders
 # -------------------------------
-def send_activity_reminders():
-    now = datetime.utcnow()
-    settings = db.collection("agencySettings").stream()
+def _run_inactivity(now, employees, settings):
+    now_iso = now.isoformat() + "Z"
+    now_ts = now.replace(tzinfo=timezone.utc).timestamp()
 
-    for s in settings:
-        agency_id = s.id
-        config = s.to_dict()
+    # Per-agency threshold in seconds; agencies with reminders off are left out
+    intervals = {}
+    for agency_id, config in settings.items():
         freq = config.get("activityReportFrequency", "30min")
-        if freq == "OFF":
-            continue
-
-        interval = {"30min": 30, "1hr": 60, "2hr": 120}.get(freq, 30)
-        employees = db.collection("employees").where("agencyId", "==", agency_id).stream()
+        if freq != "OFF":
+            intervals[agency_id] = (freq, FREQ_MINUTES.get(freq, 30) * 60)
 
-        for emp in employees:
-            e = emp.to_dict()
-            last = e.get("lastKnownLocation", {}).get("updatedAt")
-            if not last:
-                continue
-            last_seen = datetime.fromisoformat(last.replace("Z", "+00:00"))
-            if (now - last_seen).total_seconds() > interval * 60:
-                create_system_alert(
-                    agency_id,
-                    "Employee Inactivity",
-                    f"{e.get('name', 'An employee')} inactive for {freq}.",
-                    category="inactivity"
-                )
+    for e in employees:
+        agency_id = e.get("agencyId")
+        if agency_id not in intervals:
+            continue
+        last = e.get("lastKnownLocation", {}).get("updatedAt")
+        if not last:
+            continue
+        freq, interval_secs = intervals[agency_id]
+        if now_ts - iso_to_ts(last) > interval_secs:
+            create_system_alert(
+                agency_id,
+                "Employee Inactivity",
+                f"{e.get('name', 'An employee')} inactive for {freq}.",
+                category="inactivity",
+                ts=now_iso
+            )
 
 # -------------------------------
 # 📍 Geofence Leave Detection
 # -------------------------------
-def detect_geofence_leaves():
-    now = datetime.utcnow()
-    employees = db.collection("employees").stream()
-
-    for emp in employees:
-        e = emp.to_dict()
+def point_in_poly(px, py, lngs, lats):
+    # Ray casting over all edges at once: edge i runs from vertex i-1 to vertex i
+    prev_lngs = np.roll(lngs, 1)
+    prev_lats = np.roll(lats, 1)
+    straddles = (lats > py) != (prev_lats > py)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cross_lng = (prev_lngs - lngs) * (py - lats) / (prev_lats - lats) + lngs
+    return bool(np.logical_xor.reduce(straddles & (px < cross_lng)))
+
+def _run_geofence(now, employees, settings):
+    now_iso = now.isoformat() + "Z"
+    now_ts = now.replace(tzinfo=timezone.utc).timestamp()
+    site_polygons = get_site_polygons()
+
+    for e in employees:
         agency_id = e.get("agencyId")
         site_id = e.get("assignedsiteID")
         loc = e.get("lastKnownLocation")
         if not site_id or not loc or not loc.get("lat") or not loc.get("lng"):
             continue
 
-        site_doc = db.collection("sites").document(site_id).get()
-        if not site_doc.exists:
-            continue
-        site = site_doc.to_dict()
-        coords = site.get("coordinates", [])
-        if len(coords) < 3:
+        polygon = site_polygons.get(site_id)
+        if polygon is None:
             continue
 
-        point = Point(loc["lng"], loc["lat"])
-        polygon = Polygon([(c["lng"], c["lat"]) for c in coords])
-        if polygon.contains(point):
+        if point_in_poly(loc["lng"], loc["lat"], *polygon):
             continue
 
-        settings_doc = db.collection("agencySettings").document(agency_id).get()
-        settings = settings_doc.to_dict() if settings_doc.exists else {}
-        leave_time = settings.get("geofenceTriggerDelay", 10)
+        leave_time = settings.get(agency_id, {}).get("geofenceTriggerDelay", 10)
 
-        last_seen = datetime.fromisoformat(loc["updatedAt"].replace("Z", "+00:00"))
-        if (now - last_seen).total_seconds() > leave_time * 60:
+        if now_ts - iso_to_ts(loc["updatedAt"]) > leave_time * 60:
             create_system_alert(
                 agency_id,
                 "Geofence Violation",
                 f"{e.get('name')} left site fence for over {leave_time} min.",
                 category="geofence_leave",
-                site_id=site_id
+                site_id=site_id,
+                ts=now_iso
             )
 
+# -------------------------------
+# 🔄 Scheduler Tick
+# -------------------------------
+# One tick a minute runs every check that is due, so checks landing in the
+# same tick share one settings read and one employee snapshot. Each check is
+# due by the time since its own last run, so a skipped or late tick delays a
+# check by one tick, never a whole cycle.
+CHECK_INTERVALS = {
+    "grace": timedelta(minutes=1),
+    # Flags are synced on the clock-out cadence so a setting change or an
+    # unflagged new shift is picked up before the next clock-out pass
+    "flag_sync": timedelta(minutes=15),
+    "clockout": timedelta(minutes=15),
+    "stale_clockout": timedelta(hours=1),
+    "inactivity": timedelta(minutes=15),
+    "geofence": timedelta(minutes=10),
+}
+# Ticks drift by a few seconds; without slack a check could slip a minute
+TICK_SLACK = timedelta(seconds=30)
+
+_last_run = {}
+
+def _due(name, now):
+    last = _last_run.get(name)
+    return last is None or now - last >= CHECK_INTERVALS[name] - TICK_SLACK
+
+def _run_check(name, now, fn, *args):
+    # A failing check is logged without skipping the rest of the tick
+    _last_run[name] = now
+    # The check queues onto its own list so a failure discards only its alerts
+    tick_alerts = _pending_alerts()
+    _pending.alerts = []
+    try:
+        fn(now, *args)
+        tick_alerts.extend(_pending.alerts)
+    except Exception:
+        # Unflushed alerts of the failed check are dropped; its next run
+        # queues them again
+        traceback.print_exc()
+    finally:
+        _pending.alerts = tick_alerts
+
+def tick():
+    # Start from an empty queue on this thread and always flush on the way
+    # out, so no alerts are left behind for another job to commit
+    _pending_alerts().clear()
+    try:
+        _tick(datetime.utcnow())
+    finally:
+        flush_alerts()
+
+def _tick(now):
+    settings = get_agency_settings()
+
+    if _due("grace", now):
+        _run_check("grace", now, _run_grace, settings)
+    if _due("flag_sync", now):
+        _run_check("flag_sync", now, _run_flag_sync, settings)
+    if _due("clockout", now):
+        _run_check("clockout", now, _run_clockout)
+    if _due("stale_clockout", now):
+        _run_check("stale_clockout", now, _run_stale_clockout, settings)
+
+    employee_checks = [
+        (name, fn)
+        for name, fn in (("inactivity", _run_inactivity), ("geofence", _run_geofence))
+        if _due(name, now)
+    ]
+    if employee_checks:
+        try:
+            employees = load_employees()
+        except Exception:
+            # Not marked as run, so both checks retry on the next tick
+            traceback.print_exc()
+            employees = None
+        if employees is not None:
+            for name, fn in employee_checks:
+                _run_check(name, now, fn, employees, settings)
+
 # -------------------------------
 # 🧾 License Expiry Reminders
 # -------------------------------
 def send_license_reminders():
     now = datetime.utcnow()
-    settings = db.collection("agencySettings").stream()
-
-    for s in settings:
-        agency_id = s.id
-        reminder = s.to_dict().get("licenseExpiryReminder", "1week")
-        days_map = {"1week": 7, "2weeks": 14, "1month": 30}
-        days = days_map.get(reminder, 7)
-
-        licenses = db.collection("licenses").stream()
-        for lic in licenses:
-            l = lic.to_dict()
-            if l.get("agencyId") != agency_id or not l.get("expiryDate"):
-                continue
-            expiry = datetime.fromisoformat(l["expiryDate"].replace("Z", "+00:00"))
-            if 0 <= (expiry - now).days == days:
-                create_system_alert(
-                    agency_id,
-                    "License Expiry Reminder",
-                    f"Employee {l['employeeId']}'s license expires in {days} days.",
-                    category="license"
-                )
+    now_iso = now.isoformat() + "Z"
+    run_day = now.date().isoformat()
+    settings = get_agency_settings()
+
+    # Agencies already reminded today are skipped, so re-runs don't duplicate alerts
+    done = get_job_markers("licenseReminders", settings)
+    agency_reminder_days = {
+        agency_id: LICENSE_DAYS.get(config.get("licenseExpiryReminder", "1week"), 7)
+        for agency_id, config in settings.items()
+        if done.get(agency_id) != run_day
+    }
+    if not agency_reminder_days:
+        return
+
+    # Single pass over licenses, matched to their agency's reminder window.
+    # Reminders are held locally and committed in one go right before the
+    # markers, so a run that fails part-way has sent nothing and can re-run.
+    writes = []
+    licenses = paged(db.collection("licenses")
+        .select(["agencyId", "expiryDate", "employeeId"]))
+    for lic in licenses:
+        l = lic.to_dict()
+        days = agency_reminder_days.get(l.get("agencyId"))
+        if days is None or not l.get("expiryDate"):
+            continue
+        expiry = iso_to_dt(l["expiryDate"])
+        if 0 <= (expiry - now).days == days:
+            writes.append(("set", *build_system_alert(
+                l["agencyId"],
+                "License Expiry Reminder",
+                f"Employee {l['employeeId']}'s license expires in {days} days.",
+                category="license",
+                ts=now_iso
+            )))
+
+    commit_writes(writes)
+    set_job_markers("licenseReminders", agency_reminder_days, run_day)
 
 # -------------------------------
 # ⏱ APScheduler Setup
 # -------------------------------
 if __name__ == "__main__":
-    scheduler = BlockingScheduler()
-    scheduler.add_job(check_grace_violations, "interval", minutes=1)
-    scheduler.add_job(auto_clockout_expired_shifts, "interval", minutes=15)
-    scheduler.add_job(send_activity_reminders, "interval", minutes=15)
-    scheduler.add_job(detect_geofence_leaves, "interval", minutes=10)
-    scheduler.add_job(send_license_reminders, "cron", hour=7)
+    # The tick and the daily license job run on separate executor threads. A
+    # run that starts late (busy pool, slow host) is still executed instead
+    # of being dropped after the default 1s grace.
+    scheduler = BlockingScheduler(job_defaults={"misfire_grace_time": 60})
+    scheduler.add_job(tick, "interval", minutes=1)
+    # The daily run is allowed to start up to an hour late rather than being
+    # skipped for the day.
+    scheduler.add_job(send_license_reminders, "cron", hour=7, misfire_grace_time=3600)
     print("✅ SecureFront Scheduler started...")
     scheduler.start()